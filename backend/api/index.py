@@ -1,15 +1,14 @@
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi import Body
-from fastapi.responses import Response, StreamingResponse
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Callable
 from datetime import datetime, timedelta
 import hashlib
 import secrets
-import base64
 import os
 import json
 import re
@@ -17,26 +16,49 @@ import jwt
 import zipfile
 import io
 import stripe
+import time
+from functools import lru_cache
 from jwt.exceptions import PyJWTError
+from cachetools import TTLCache
 
 stripe.api_key = os.getenv("STRIPE_API_KEY")
-try:
-    from mistralai.client import MistralClient
-    from mistralai.models import ChatMessage
-    use_new_api = True
-except ImportError:
-    from mistralai import Mistral
-    use_new_api = False
+from mistralai import Mistral
+from mistralai.utils import BackoffStrategy, RetryConfig
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
 import uuid
+import atexit
+import queue
+import logging
+import logging.handlers
+import asyncio
+import weakref
+import httpx
+import orjson
 
 # Load environment variables
 load_dotenv()
 
+# --- Logging ---
+# Request-path tracing is logged at DEBUG so it is skipped (not even formatted) at the default INFO level.
+# Records go through a queue to a background listener thread, so emitting a log line never blocks
+# the event loop on a stdout write.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which would mean a log line per Supabase/Mistral call
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # --- FastAPI App ---
-app = FastAPI(title="TerraformCoder AI API")
+# orjson serializes the large generate/history payloads much faster than the stdlib encoder
+app = FastAPI(title="TerraformCoder AI API", default_response_class=ORJSONResponse)
 
 # --- CORS Middleware ---
 app.add_middleware(
@@ -47,14 +69,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Compression ---
+# Generated files, explanations and history payloads are tens of KB of text; gzip shrinks them several-fold
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 from starlette.requests import Request
+from starlette.background import BackgroundTask
 from fastapi.responses import JSONResponse
 import traceback
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     tb = traceback.format_exc()
-    print(f"GLOBAL ERROR: {tb}")
+    logger.error("GLOBAL ERROR: %s", tb)
     return JSONResponse(
         status_code=500,
         content={"detail": "Internal Server Error", "error": str(exc), "traceback": tb}
@@ -64,13 +91,39 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 
 # --- Security ---
-security = HTTPBearer()
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")  # Replace in prod
-if not SECRET_KEY:
-    raise ValueError("JWT_SECRET_KEY must be set in environment variables for token generation.")
-ALGORITHM = "HS256"
+# An Ed25519 keypair (PEM) switches tokens to EdDSA: faster to verify than HS256 and only the
+# public key is needed on verifying nodes. Without one we fall back to the shared HS256 secret.
+JWT_PRIVATE_KEY = os.getenv("JWT_PRIVATE_KEY")
+JWT_PUBLIC_KEY = os.getenv("JWT_PUBLIC_KEY")
+if JWT_PRIVATE_KEY and JWT_PUBLIC_KEY:
+    ALGORITHM = "EdDSA"
+    # Parse the PEMs once instead of on every encode/decode call.
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+    JWT_SIGNING_KEY = load_pem_private_key(JWT_PRIVATE_KEY.replace("\\n", "\n").encode(), password=None)
+    JWT_VERIFYING_KEY = load_pem_public_key(JWT_PUBLIC_KEY.replace("\\n", "\n").encode())
+else:
+    SECRET_KEY = os.getenv("JWT_SECRET_KEY")  # Replace in prod
+    if not SECRET_KEY:
+        raise ValueError("JWT_SECRET_KEY (or JWT_PRIVATE_KEY and JWT_PUBLIC_KEY) must be set in environment variables for token generation.")
+    ALGORITHM = "HS256"
+    # Encode the signing key once instead of on every encode/decode call.
+    JWT_SIGNING_KEY = JWT_VERIFYING_KEY = SECRET_KEY.encode()
+# Decoder with the required claims baked in, so they are checked in the same pass as the signature
+jwt_decoder = jwt.PyJWT(options={"require": ["exp", "sub"]})
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# Verified JWT payloads keyed by a digest of the token, so repeat requests skip the HMAC check
+# and the cache never holds raw bearer tokens. Entries are also checked against the token's
+# own `exp` before being reused.
+_jwt_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+# User rows for authenticated requests, so an active user costs one Supabase lookup per TTL window.
+# Routes only read `id` and `email` off the row, which don't change under a live token, so a
+# few minutes of staleness is safe (and well inside the token lifetime).
+_user_cache: TTLCache = TTLCache(maxsize=10000, ttl=300)
+# User ids that Supabase has no row for, so a valid token for a deleted/unknown user (or a flood of
+# them) is rejected without a round trip each time. Only confirmed misses land here, never DB errors.
+_missing_user_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+
 # --- Supabase Client ---
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY")
@@ -83,24 +136,65 @@ try:
     
     # Use service key for backend operations to bypass RLS for user creation
     if SUPABASE_SERVICE_KEY:
-        print("Initializing Supabase client with service key.")
+        logger.info("Initializing Supabase client with service key.")
         supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
     else:
-        print("Initializing Supabase client with anon key.")
+        logger.info("Initializing Supabase client with anon key.")
         supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 except Exception as e:
-    print(f"Error connecting to Supabase: {e}")
+    logger.warning("Error connecting to Supabase: %s", e)
     supabase = None
 
 # --- Mistral AI Client ---
-if use_new_api:
-    mistral_client = MistralClient(api_key=os.getenv("MISTRAL_API_KEY"))
-else:
-    mistral_client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+@lru_cache(maxsize=1)
+def get_mistral_client():
+    """Build the Mistral client on first use so cold starts of non-AI routes skip it"""
+    # Back off (exponential, with jitter) on 429/5xx instead of failing the file or generation outright;
+    # capped at 30s total so a rate-limited call can't outlive the request
+    return Mistral(
+        api_key=os.getenv("MISTRAL_API_KEY"),
+        retry_config=RetryConfig("backoff", BackoffStrategy(500, 8000, 2.0, 30000), retry_connection_errors=True)
+    )
+
 MISTRAL_MODEL = "codestral-latest"
+# Max in-flight per-file explanation requests for a single generation
+EXPLANATION_CONCURRENCY = 8
+# Max generations running against Mistral at once per worker; extra requests queue instead of
+# piling onto the upstream rate limit
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+# Keyed by loop like the HTTP clients below, since an asyncio.Semaphore binds to one loop
+_generation_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def get_generation_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _generation_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _generation_semaphores[loop] = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+    return semaphore
+
+# --- Shared HTTP client ---
+# One AsyncClient per event loop so outbound calls (Mermaid) reuse keep-alive connections.
+# Keyed by loop because serverless invocations may each run on a fresh loop.
+_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared httpx client for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            # HTTP/2 multiplexes concurrent renders over one connection instead of one per request
+            http2=True,
+            timeout=30.0,
+            # Renders are sporadic, so keep idle connections well past httpx's 5s default
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300)
+        )
+        _http_clients[loop] = client
+    return client
 
 # --- In-memory cache ---
-response_cache: Dict[str, Dict] = {}
+# Bounded so long-lived workers don't hold every generation forever; entries expire after an hour.
+response_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
 
 # --- Enhanced Pydantic Models ---
 class FileContent(BaseModel):
@@ -149,6 +243,53 @@ class GenerateResponse(BaseModel):
     architecture_diagram: Optional[ArchitectureDiagram] = None
 
 # --- Helper Functions ---
+# Regexes used on every generation are compiled once at import
+FILE_BLOCK_RE = re.compile(r'```(\w+):([^\n]+)\n(.*?)\n```', re.DOTALL)  # ```lang:filename fenced file blocks
+BRACKET_LABEL_RE = re.compile(r'\[(.*?)\]')  # Mermaid node labels, e.g. A[Load Balancer]
+JSON_BLOCK_RE = re.compile(r'```json(.*?)```', re.DOTALL)  # the ```json metadata block, without copying the rest of the reply
+
+# Keyword tables for the text classifiers below, built once at import
+FILE_CATEGORY_KEYWORDS = (
+    ('compute', ('azurerm_virtual_machine', 'aws_instance', 'google_compute_instance', 'ec2', 'vm')),
+    ('network', ('azurerm_virtual_network', 'aws_vpc', 'google_compute_network', 'subnet', 'security_group')),
+    ('database', ('azurerm_sql_database', 'aws_rds', 'google_sql_database', 'database', 'mysql', 'postgresql')),
+    ('automation', ('ansible', 'playbook', 'role', 'task')),
+)
+PROVIDER_KEYWORDS = {
+    'aws': ('aws', 'amazon', 'ec2', 's3', 'rds', 'lambda'),
+    'azure': ('azure', 'microsoft', 'vm', 'blob', 'cosmos'),
+    'gcp': ('gcp', 'google', 'gce', 'cloud storage', 'bigquery'),
+}
+INFRASTRUCTURE_KEYWORDS = (
+    'vm', 'virtual machine', 'ec2', 'instance', 'server', 'compute',
+    'vpc', 'network', 'subnet', 'security group', 'firewall',
+    'database', 'rds', 'mysql', 'postgresql', 'storage', 's3', 'blob',
+    'load balancer', 'alb', 'nlb', 'api gateway', 'lambda', 'function',
+    'kubernetes', 'container', 'docker', 'ecs', 'aks', 'gke',
+    'terraform', 'infrastructure', 'cloud', 'aws', 'azure', 'gcp',
+    'deploy', 'provision', 'create', 'setup', 'configure'
+)
+
+_now_iso_cache = {"at": 0.0, "value": ""}
+
+def fenced_block_body(text: str, fence: str) -> Optional[str]:
+    """Return the stripped text after the first `fence` up to the next ``` (or the end), or None if `fence` is absent"""
+    # find() + one slice, instead of split() copying every piece of the reply
+    start = text.find(fence)
+    if start < 0:
+        return None
+    start += len(fence)
+    end = text.find("```", start)
+    return text[start:end if end >= 0 else len(text)].strip()
+
+def utc_now_iso() -> str:
+    """Return the current UTC time as an ISO string, re-formatted at most every 100ms"""
+    now = time.monotonic()
+    if now - _now_iso_cache["at"] >= 0.1:
+        _now_iso_cache["value"] = datetime.utcnow().isoformat()
+        _now_iso_cache["at"] = now
+    return _now_iso_cache["value"]
+
 def classify_file_type(filename: str, content: str) -> tuple[str, str]:
     """Classify file type and category using deep learning approach"""
     filename_lower = filename.lower()
@@ -162,47 +303,43 @@ def classify_file_type(filename: str, content: str) -> tuple[str, str]:
     else:
         file_type = 'config'
     
-    # Category classification based on content patterns
-    if any(keyword in content_lower for keyword in ['azurerm_virtual_machine', 'aws_instance', 'google_compute_instance', 'ec2', 'vm']):
-        category = 'compute'
-    elif any(keyword in content_lower for keyword in ['azurerm_virtual_network', 'aws_vpc', 'google_compute_network', 'subnet', 'security_group']):
-        category = 'network'
-    elif any(keyword in content_lower for keyword in ['azurerm_sql_database', 'aws_rds', 'google_sql_database', 'database', 'mysql', 'postgresql']):
-        category = 'database'
-    elif any(keyword in content_lower for keyword in ['ansible', 'playbook', 'role', 'task']):
-        category = 'automation'
-    else:
-        category = 'infrastructure'
+    # Category classification based on content patterns (first matching category wins)
+    category = 'infrastructure'
+    for candidate, keywords in FILE_CATEGORY_KEYWORDS:
+        if any(keyword in content_lower for keyword in keywords):
+            category = candidate
+            break
     
     return file_type, category
 
-async def generate_file_hierarchy(files: List[FileContent]) -> str:
+def generate_file_hierarchy(files: List[FileContent]) -> str:
     """Generate a tree-like file hierarchy from the generated files"""
     if not files:
         return "No files generated"
 
     tree = {}
     for file in files:
-        parts = file.filename.split('/')
         current_level = tree
-        for part in parts:
-            if part not in current_level:
-                current_level[part] = {}
-            current_level = current_level[part]
-
-    def build_tree_lines(tree, prefix=""):
-        lines = []
-        entries = list(tree.keys())
-        for i, entry in enumerate(entries):
-            connector = "├── " if i < len(entries) - 1 else "└── "
-            lines.append(f"{prefix}{connector}{entry}")
-            if tree[entry]:
-                new_prefix = "│   " if i < len(entries) - 1 else "    "
-                lines.extend(build_tree_lines(tree[entry], prefix + new_prefix))
-        return lines
+        for part in file.filename.split('/'):
+            current_level = current_level.setdefault(part, {})
 
     tree_lines = ["terraform-infrastructure/"]
-    tree_lines.extend(build_tree_lines(tree))
+    # Iterative depth-first walk; children are pushed in reverse so they pop in insertion order
+    stack = []
+
+    def push_children(subtree, prefix):
+        entries = list(subtree.items())
+        last = len(entries) - 1
+        for i in range(last, -1, -1):
+            name, children = entries[i]
+            stack.append((name, children, prefix, i == last))
+
+    push_children(tree, "")
+    while stack:
+        name, children, prefix, is_last = stack.pop()
+        tree_lines.append(f"{prefix}{'└── ' if is_last else '├── '}{name}")
+        if children:
+            push_children(children, prefix + ("    " if is_last else "│   "))
     return "\n".join(tree_lines)
 
 async def generate_file_explanation(filename: str, content: str, file_type: str, category: str) -> str:
@@ -222,51 +359,19 @@ Write exactly 3-4 sentences covering: (1) what this file provisions and why, (2)
 """
 
     try:
-        if use_new_api:
-            messages = [ChatMessage(role="user", content=explanation_prompt)]
-            response = mistral_client.chat(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=250
-            )
-        else:
-            messages = [{"role": "user", "content": explanation_prompt}]
-            response = mistral_client.chat.complete(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=250
-            )
+        messages = [{"role": "user", "content": explanation_prompt}]
+        response = await get_mistral_client().chat.complete_async(
+            model=MISTRAL_MODEL,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=250
+        )
         
         return response.choices[0].message.content.strip()
     except Exception as e:
-        print(f"Error generating explanation for {filename}: {e}")
+        logger.warning("Error generating explanation for %s: %s", filename, e)
         return f"Configuration file for {category} components. Contains essential infrastructure definitions and settings."
 
-#async def create_mermaid_chart(mermaid_syntax: str) -> Optional[str]:
-    """Create a mermaidchart.com URL for the given Mermaid syntax"""
-    try:
-        # Prepare the data for mermaidchart.com
-        chart_data = {
-            "code": mermaid_syntax,
-            "mermaid": {
-                "theme": "light"
-            },
-            "autoSync": True,
-            "updateEditor": False
-        }
-        
-        # Create a shareable URL using mermaidchart.com API
-        # Note: This is a simplified approach. In production, you might want to use their official API
-        encoded_data = base64.urlsafe_b64encode(json.dumps(chart_data).encode()).decode()
-        mermaid_url = f"https://mermaid.live/edit#{encoded_data}"
-        
-        return mermaid_url
-    except Exception as e:
-        print(f"Error creating mermaid chart URL: {e}")
-        return None
-
 async def generate_architecture_diagram(description: str, resources: List[str], provider: str) -> ArchitectureDiagram:
     """Generate architecture diagram in Mermaid.js syntax with enhanced AI generation"""
 
@@ -300,39 +405,30 @@ Return ONLY the Mermaid syntax starting with 'graph TD' or 'graph LR'.
 """
 
     try:
-        if use_new_api:
-            messages = [ChatMessage(role="user", content=diagram_prompt)]
-            response = mistral_client.chat(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=800
-            )
-        else:
-            messages = [{"role": "user", "content": diagram_prompt}]
-            response = mistral_client.chat.complete(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=800
-            )
+        messages = [{"role": "user", "content": diagram_prompt}]
+        response = await get_mistral_client().chat.complete_async(
+            model=MISTRAL_MODEL,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=800
+        )
         
         ai_generated_mermaid = response.choices[0].message.content.strip()
 
         # Clean up the response to extract only the Mermaid syntax
-        mermaid_syntax = ai_generated_mermaid
-        if "```mermaid" in ai_generated_mermaid:
-            mermaid_syntax = ai_generated_mermaid.split("```mermaid")[1].split("```")[0].strip()
-        elif "```" in ai_generated_mermaid:
-            mermaid_syntax = ai_generated_mermaid.split("```")[1].strip()
+        mermaid_syntax = fenced_block_body(ai_generated_mermaid, "```mermaid")
+        if mermaid_syntax is None:
+            mermaid_syntax = fenced_block_body(ai_generated_mermaid, "```")
+        if mermaid_syntax is None:
+            mermaid_syntax = ai_generated_mermaid
 
         # Basic validation of Mermaid syntax
         if not (mermaid_syntax.startswith("graph TD") or mermaid_syntax.startswith("graph LR")) or "-->" not in mermaid_syntax:
-            print(f"WARNING: AI generated invalid Mermaid syntax. Falling back to basic diagram. Invalid syntax: {mermaid_syntax}")
+            logger.warning("AI generated invalid Mermaid syntax. Falling back to basic diagram. Invalid syntax: %s", mermaid_syntax)
             mermaid_syntax = await generate_basic_mermaid_diagram(resources, provider)
 
     except Exception as e:
-        print(f"Error generating AI diagram: {e}")
+        logger.warning("Error generating AI diagram: %s", e)
         # Fallback to basic diagram generation
         mermaid_syntax = await generate_basic_mermaid_diagram(resources, provider)
 
@@ -349,13 +445,8 @@ Return ONLY the Mermaid syntax starting with 'graph TD' or 'graph LR'.
             if len(parts) == 2:
                 from_node = parts[0].strip()
                 to_node = parts[1].strip()
-                try:
-                    from_name = re.sub(r'\[(.*?)\]', r'\1', from_node)
-                    to_name = re.sub(r'\[(.*?)\]', r'\1', to_node)
-                except re.error as e:
-                    print(f"Regex error: {e}")
-                    from_name = from_node
-                    to_name = to_node
+                from_name = BRACKET_LABEL_RE.sub(r'\1', from_node)
+                to_name = BRACKET_LABEL_RE.sub(r'\1', to_node)
                 connections.append({
                     "from": from_name,
                     "to": to_name,
@@ -363,53 +454,11 @@ Return ONLY the Mermaid syntax starting with 'graph TD' or 'graph LR'.
                 })
         elif '[' in line and ']' in line:
             # Extract component names from node definitions
-            try:
-                matches = re.findall(r'\[(.*?)\]', line)
-            except re.error as e:
-                print(f"Regex error: {e}")
-                matches = []
-            components.extend(matches)
-
-    # Remove duplicates and clean up
-    components = list(set([comp for comp in components if comp]))
-    
-    # Create mermaidchart.com URL
-    #mermaid_chart_url = await create_mermaid_chart(mermaid_syntax)
-    
-    async def create_mermaid_chart(mermaid_syntax: str) -> Optional[str]:
-        """Create Mermaid chart URL, preferring token API if available."""
-        token = os.getenv("MERMAID_API_TOKEN")
-        try:
-            if token:
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    resp = await client.post(
-                        "https://api.mermaidchart.com/v1/charts",
-                        headers={
-                            "Authorization": f"Bearer {token}",
-                            "Content-Type": "application/json"
-                        },
-                        json={
-                            "code": mermaid_syntax,
-                            "theme": "light",
-                            "autoSync": True
-                        }
-                    )
-                if resp.status_code == 200:
-                    data = resp.json()
-                    return data.get("shareUrl") or data.get("url")
-                else:
-                    print("Mermaid API error:", resp.text)
-
-            # Fallback to free live link
-            chart_data = {"code": mermaid_syntax, "mermaid": {"theme": "dark"}}
-            encoded_data = base64.urlsafe_b64encode(json.dumps(chart_data).encode()).decode()
-            return f"https://mermaid.live/edit#{encoded_data}"
-
-        except Exception as e:
-            print(f"Error creating mermaid chart: {e}")
-            return None
-
+            components.extend(BRACKET_LABEL_RE.findall(line))
 
+    # Remove duplicates and empties, keeping diagram order so the top-10 cut below is stable
+    components = list(dict.fromkeys(comp for comp in components if comp))
+    
     diagram_description = f"Architecture diagram for {provider} infrastructure showing the relationships between {len(components)} main components including compute, storage, networking, and security layers."
 
     return ArchitectureDiagram(
@@ -417,63 +466,64 @@ Return ONLY the Mermaid syntax starting with 'graph TD' or 'graph LR'.
         diagram_description=diagram_description,
         components=components[:10],  # Limit to top 10 components
         connections=connections[:10],  # Limit to top 10 connections
-        #mermaid_chart_url=mermaid_chart_url
     )
 
+# Fallback diagrams only depend on the provider, so they are built once at import
+BASIC_MERMAID_DIAGRAMS = {
+    'aws': "\n".join([
+        "graph TD",
+        "    A[User] --> B[Application Load Balancer]",
+        "    B --> C[EC2 Instance]",
+        "    C --> D[RDS Database]",
+        "    C --> E[S3 Storage]"
+    ]),
+    'azure': "\n".join([
+        "graph TD",
+        "    A[User] --> B[Azure Load Balancer]",
+        "    B --> C[Virtual Machine]",
+        "    C --> D[Azure SQL Database]",
+        "    C --> E[Blob Storage]"
+    ]),
+    'gcp': "\n".join([
+        "graph TD",
+        "    A[User] --> B[Load Balancing]",
+        "    B --> C[Compute Engine]",
+        "    C --> D[Cloud SQL]",
+        "    C --> E[Cloud Storage]"
+    ]),
+}
+
 async def generate_basic_mermaid_diagram(resources: List[str], provider: str) -> str:
     """Generate a basic Mermaid diagram as fallback"""
-    mermaid_lines = ["graph TD"]
+    return BASIC_MERMAID_DIAGRAMS.get(provider, "graph TD")
+
+def file_from_block(filename: str, file_content: str) -> Optional[Dict[str, str]]:
+    """Clean up one ```lang:filename code block, returning None for empty files"""
+    filename = filename.strip()
+    file_content = file_content.strip()
     
-    # Define basic nodes based on provider
-    if provider == 'aws':
-        mermaid_lines.extend([
-            "    A[User] --> B[Application Load Balancer]",
-            "    B --> C[EC2 Instance]",
-            "    C --> D[RDS Database]",
-            "    C --> E[S3 Storage]"
-        ])
-    elif provider == 'azure':
-        mermaid_lines.extend([
-            "    A[User] --> B[Azure Load Balancer]",
-            "    B --> C[Virtual Machine]",
-            "    C --> D[Azure SQL Database]",
-            "    C --> E[Blob Storage]"
-        ])
-    elif provider == 'gcp':
-        mermaid_lines.extend([
-            "    A[User] --> B[Load Balancing]",
-            "    B --> C[Compute Engine]",
-            "    C --> D[Cloud SQL]",
-            "    C --> E[Cloud Storage]"
-        ])
+    # Skip empty files
+    if not file_content:
+        return None
+        
+    # Clean filename
+    if filename.startswith('```') or filename.startswith('File:'):
+        filename = filename.replace('```', '').replace('File:', '').strip()
     
-    return "\n".join(mermaid_lines)
+    return {
+        'filename': filename,
+        'content': file_content
+    }
 
 def parse_generated_files(content: str) -> List[Dict[str, str]]:
     """Parse generated content into individual files with enhanced detection"""
     
     files = []
     
-    # Enhanced regex pattern for file detection
-    file_pattern = r'```(\w+):([^\n]+)\n(.*?)\n```'
-    matches = re.findall(file_pattern, content, re.DOTALL)
-    
-    for lang, filename, file_content in matches:
-        filename = filename.strip()
-        file_content = file_content.strip()
-        
-        # Skip empty files
-        if not file_content:
-            continue
-            
-        # Clean filename
-        if filename.startswith('```') or filename.startswith('File:'):
-            filename = filename.replace('```', '').replace('File:', '').strip()
-        
-        files.append({
-            'filename': filename,
-            'content': file_content
-        })
+    for lang, filename, file_content in FILE_BLOCK_RE.findall(content):
+        file_data = file_from_block(filename, file_content)
+        if file_data:
+            files.append(file_data)
     
     # If no files found, treat entire content as main.tf
     if not files and content.strip():
@@ -484,92 +534,64 @@ def parse_generated_files(content: str) -> List[Dict[str, str]]:
     
     return files
 
-async def process_generated_files(parsed_files: List[Dict[str, str]]) -> List[FileContent]:
-    """Process parsed files with AI-generated explanations"""
+async def process_generated_file(file_data: Dict[str, str], semaphore: asyncio.Semaphore) -> FileContent:
+    """Classify one parsed file and attach its AI-generated explanation"""
+    filename = file_data['filename']
+    content = file_data['content']
     
-    processed_files = []
+    # Classify file
+    file_type, category = classify_file_type(filename, content)
     
-    for file_data in parsed_files:
-        filename = file_data['filename']
-        content = file_data['content']
-        
-        # Classify file
-        file_type, category = classify_file_type(filename, content)
-        
-        # Generate AI-powered explanation for each file
-        try:
+    # Generate AI-powered explanation for each file
+    try:
+        async with semaphore:
             explanation = await generate_file_explanation(filename, content, file_type, category)
-        except Exception as e:
-            print(f"Explanation generation failed for {filename}: {e}")
-            explanation = f"Configuration file for {category} components. Contains essential infrastructure definitions and settings."
-        
-        processed_files.append(FileContent(
-            filename=filename,
-            content=content,
-            explanation=explanation,
-            file_type=file_type,
-            category=category
-        ))
+    except Exception as e:
+        logger.warning("Explanation generation failed for %s: %s", filename, e)
+        explanation = f"Configuration file for {category} components. Contains essential infrastructure definitions and settings."
     
-    return processed_files
+    return FileContent(
+        filename=filename,
+        content=content,
+        explanation=explanation,
+        file_type=file_type,
+        category=category
+    )
 
 def detect_cloud_provider(description: str) -> List[str]:
     """Detect which cloud providers are mentioned in the description"""
     providers = []
     description_lower = description.lower()
     
-    if any(keyword in description_lower for keyword in ['aws', 'amazon', 'ec2', 's3', 'rds', 'lambda']):
-        providers.append('aws')
-    if any(keyword in description_lower for keyword in ['azure', 'microsoft', 'vm', 'blob', 'cosmos']):
-        providers.append('azure')
-    if any(keyword in description_lower for keyword in ['gcp', 'google', 'gce', 'cloud storage', 'bigquery']):
-        providers.append('gcp')
+    for provider, keywords in PROVIDER_KEYWORDS.items():
+        if any(keyword in description_lower for keyword in keywords):
+            providers.append(provider)
     
     if not providers:
         providers = ['aws', 'azure', 'gcp']
     
     return providers
 
-def is_valid_infrastructure_request(description: str) -> bool:
-    print(f"Checking validity for description: {description}")
-    infrastructure_keywords = [
-        'vm', 'virtual machine', 'ec2', 'instance', 'server', 'compute',
-        'vpc', 'network', 'subnet', 'security group', 'firewall',
-        'database', 'rds', 'mysql', 'postgresql', 'storage', 's3', 'blob',
-        'load balancer', 'alb', 'nlb', 'api gateway', 'lambda', 'function',
-        'kubernetes', 'container', 'docker', 'ecs', 'aks', 'gke',
-        'terraform', 'infrastructure', 'cloud', 'aws', 'azure', 'gcp',
-        'deploy', 'provision', 'create', 'setup', 'configure'
-    ]
-    
-    description_lower = description.lower()
-    is_valid = any(keyword in description_lower for keyword in infrastructure_keywords)
-    print(f"Description is valid: {is_valid}")
+def normalize_description(description: str) -> str:
+    """Normalize a description for cache lookups so case and whitespace variants share an entry"""
+    return " ".join(description.lower().split())
+
+@lru_cache(maxsize=4096)
+def has_infrastructure_keyword(description_lower: str) -> bool:
+    # Cached because the same prompts are resubmitted often
+    return any(keyword in description_lower for keyword in INFRASTRUCTURE_KEYWORDS)
+
+def is_valid_infrastructure_request(description: str, description_lower: Optional[str] = None) -> bool:
+    logger.debug("Checking validity for description: %s", description)
+    # Callers that already hold a lowercased copy (e.g. normalize_description's output) can pass it in
+    if description_lower is None:
+        description_lower = description.lower()
+    is_valid = has_infrastructure_keyword(description_lower)
+    logger.debug("Description is valid: %s", is_valid)
     return is_valid
 
-# --- AI Model Call (Enhanced) ---
-async def call_ai_model(description: str, provider: str, include_diagram: bool = True, conversation_history: List[dict] = []):
-    """Enhanced AI model call with dynamic file processing and multi-turn conversation support"""
-    
-    if not is_valid_infrastructure_request(description):
-        return {
-            "files": [],
-            "explanation": "Please provide a clear description of your cloud infrastructure requirements.",
-            "resources": [],
-            "estimated_cost": "Unknown",
-            "file_hierarchy": "",
-            "is_valid_request": False,
-            "architecture_diagram": None
-        }
-    
-    # Only use cache for single-turn (no conversation history)
-    cache_key = hashlib.sha256(f"{description}-{provider}".encode()).hexdigest()
-    if not conversation_history and cache_key in response_cache:
-        cached_data = response_cache[cache_key]
-        cached_data["cached_response"] = True
-        return cached_data
-
-    system_prompt = f"""
+# System prompt for call_ai_model; only `provider` varies, so each variant is formatted once and reused.
+SYSTEM_PROMPT_TEMPLATE = """
 You are a highly experienced DevOps and Cloud Infrastructure Engineer specialized in writing production-grade, enterprise level modularity, and cost-efficient Terraform code for the {provider} cloud provider.
 
 Your task is to generate ONLY valid and deployment-ready Terraform code and include ansible playbooks according to the user's infrastructure description.
@@ -660,90 +682,191 @@ Optionally include additional files as needed:
 }}
 """
 
+# provider is a free-form client string, so the cache is bounded rather than one entry per value seen
+@lru_cache(maxsize=16)
+def get_system_prompt(provider: str) -> str:
+    """Return the Terraform system prompt for a provider, formatting it on first use"""
+    return SYSTEM_PROMPT_TEMPLATE.format(provider=provider)
+
+# --- AI Model Call (Enhanced) ---
+# Single-turn generations currently running, keyed like response_cache
+_inflight_generations: Dict[tuple[str, str, bool], asyncio.Task] = {}
+
+def _forget_inflight_generation(cache_key: tuple[str, str, bool], task: asyncio.Task):
+    if _inflight_generations.get(cache_key) is task:
+        del _inflight_generations[cache_key]
+
+def generation_cache_key(normalized_description: str, provider: str, include_diagram: bool) -> tuple[str, str, bool]:
+    """Key for response_cache and _inflight_generations"""
+    # A plain tuple key: no hashing step to build it and no possible collisions. include_diagram is
+    # part of it so a diagram-less request never gets a diagram back (or vice versa)
+    return (normalized_description, provider, include_diagram)
+
+def get_cached_generation(cache_key: tuple[str, str, bool]) -> Optional[Dict]:
+    """Return a copy of a cached single-turn result marked as cached, or None"""
+    cached_data = response_cache.get(cache_key)
+    if cached_data is None:
+        return None
+    cached_data = cached_data.copy()
+    cached_data["cached_response"] = True
+    return cached_data
+
+def get_inflight_generation(cache_key: tuple[str, str, bool]) -> Optional[asyncio.Task]:
+    """Return the single-turn generation already running for this key on the current loop, if any"""
+    pending = _inflight_generations.get(cache_key)
+    if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+        return pending
+    return None
+
+async def run_shared_generation(cache_key: tuple[str, str, bool], description: str, provider: str, include_diagram: bool, on_delta: Optional[Callable[[str], None]] = None) -> Dict:
+    """Run a single-turn generation and cache its result"""
+    result = await run_limited_generation(description, provider, include_diagram, [], on_delta)
+    response_cache[cache_key] = result.copy()
+    return result
+
+def start_shared_generation(cache_key: tuple[str, str, bool], description: str, provider: str, include_diagram: bool, on_delta: Optional[Callable[[str], None]] = None) -> asyncio.Task:
+    """Start a single-turn generation that identical requests can join until it finishes"""
+    task = asyncio.get_running_loop().create_task(run_shared_generation(cache_key, description, provider, include_diagram, on_delta))
+    _inflight_generations[cache_key] = task
+    task.add_done_callback(lambda done: _forget_inflight_generation(cache_key, done))
+    return task
+
+async def stream_generated_files(messages: List[dict], semaphore: asyncio.Semaphore, file_tasks: List[asyncio.Task], on_delta: Optional[Callable[[str], None]] = None) -> str:
+    """Stream the main completion, starting each file's explanation as soon as its code block closes"""
+    stream = await get_mistral_client().chat.stream_async(
+        model=MISTRAL_MODEL,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=3500
+    )
+    content = ""
+    scan_pos = 0  # everything before this offset has already been matched
+    async with stream:
+        async for event in stream:
+            if not event.data.choices:
+                continue
+            delta = event.data.choices[0].delta.content
+            if not isinstance(delta, str) or not delta:
+                continue
+            content += delta
+            if on_delta is not None:
+                on_delta(delta)
+            # A block can only have closed if this delta carries its closing fence, so skip
+            # rescanning the still-open block on every other delta (that rescan is quadratic)
+            if "`" not in delta:
+                continue
+            for match in FILE_BLOCK_RE.finditer(content, scan_pos):
+                scan_pos = match.end()
+                file_data = file_from_block(match.group(2), match.group(3))
+                if file_data:
+                    file_tasks.append(asyncio.create_task(process_generated_file(file_data, semaphore)))
+    return content.strip()
+
+async def run_limited_generation(description: str, provider: str, include_diagram: bool, conversation_history: List[dict], on_delta: Optional[Callable[[str], None]] = None) -> Dict:
+    """Run the generation pipeline once a slot under AI_MAX_CONCURRENCY is free"""
+    async with get_generation_semaphore():
+        return await run_generation_pipeline(description, provider, include_diagram, conversation_history, on_delta)
+
+async def run_generation_pipeline(description: str, provider: str, include_diagram: bool, conversation_history: List[dict], on_delta: Optional[Callable[[str], None]] = None) -> Dict:
+    """Call Mistral for the Terraform files, then explain each file and draw the diagram"""
+    system_prompt = get_system_prompt(provider)
+
     user_message = f"Generate Terraform code for {provider} to {description}."
 
+    semaphore = asyncio.Semaphore(EXPLANATION_CONCURRENCY)
+    file_tasks: List[asyncio.Task] = []
     try:
         # Build messages dynamically with conversation history support
-        if use_new_api:
-            messages = [ChatMessage(role="system", content=system_prompt)]
-            # Append conversation history (multi-turn)
-            for msg in conversation_history:
-                messages.append(ChatMessage(role=msg.get("role", "user"), content=msg.get("content", "")))
-            # Append current user message
-            messages.append(ChatMessage(role="user", content=user_message))
-            response = mistral_client.chat(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=3500
-            )
-        else:
-            messages = [{"role": "system", "content": system_prompt}]
-            # Append conversation history (multi-turn)
-            for msg in conversation_history:
-                messages.append({"role": msg.get("role", "user"), "content": msg.get("content", "")})
-            # Append current user message
-            messages.append({"role": "user", "content": user_message})
-            response = mistral_client.chat.complete(
-                model=MISTRAL_MODEL,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=3500
-            )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Parse files
-        parsed_files = parse_generated_files(content)
-        
-        # Process files with AI explanations
-        processed_files = await process_generated_files(parsed_files)
+        messages = [{"role": "system", "content": system_prompt}]
+        # Append conversation history (multi-turn)
+        for msg in conversation_history:
+            messages.append({"role": msg.get("role", "user"), "content": msg.get("content", "")})
+        # Append current user message
+        messages.append({"role": "user", "content": user_message})
+        content = await stream_generated_files(messages, semaphore, file_tasks, on_delta)
         
-        # Generate file hierarchy
-        file_hierarchy = await generate_file_hierarchy(processed_files)
+        # Parse files that weren't already picked up while streaming (including the main.tf fallback)
+        if not file_tasks:
+            file_tasks = [asyncio.create_task(process_generated_file(file_data, semaphore)) for file_data in parse_generated_files(content)]
         
-        # Extract metadata
+        # Extract metadata (before the explanation/diagram calls so the diagram sees the resource list)
         metadata = {}
-        json_start_tag = "```json"
-        if json_start_tag in content:
-            parts = content.split(json_start_tag, 1)
-            if len(parts) > 1:
-                json_block_potential = parts[1]
-                code_end_tag = "```"
-                if code_end_tag in json_block_potential:
-                    json_block = json_block_potential.split(code_end_tag, 1)[0].strip()
-                    try:
-                        metadata = json.loads(json_block)
-                    except json.JSONDecodeError as e:
-                        print(f"WARNING: Could not decode JSON: {e}")
-                        metadata = {}
+        json_match = JSON_BLOCK_RE.search(content)
+        if json_match:
+            try:
+                metadata = orjson.loads(json_match.group(1).strip())
+            except orjson.JSONDecodeError as e:
+                logger.warning("Could not decode JSON: %s", e)
+                metadata = {}
         
-        # Generate architecture diagram (static fallback to avoid second Mistral call / timeout)
-        architecture_diagram = None
-        if include_diagram:
+        # Generate architecture diagram (falls back to a static diagram on failure)
+        async def build_architecture_diagram():
+            if not include_diagram:
+                return None
             resources = metadata.get("resources", [])
             try:
-                architecture_diagram = await generate_architecture_diagram(description, resources, provider)
+                return await generate_architecture_diagram(description, resources, provider)
             except Exception as diag_err:
-                print(f"WARNING: Diagram generation failed, skipping: {diag_err}")
-                architecture_diagram = None
+                logger.warning("Diagram generation failed, skipping: %s", diag_err)
+                return None
         
-        result = {
-            "files": processed_files,
-            "explanation": metadata.get("explanation", "Infrastructure code generated successfully."),
-            "resources": metadata.get("resources", []),
-            "estimated_cost": metadata.get("estimated_cost", "Unknown"),
-            "file_hierarchy": file_hierarchy,  # Now properly generated
-            "is_valid_request": True,
-            "architecture_diagram": architecture_diagram
-        }
+        # File explanations and the diagram are independent Mistral calls, so run them together
+        processed_files, architecture_diagram = await asyncio.gather(
+            asyncio.gather(*file_tasks),
+            build_architecture_diagram()
+        )
+    except BaseException:
+        # Don't leave explanation calls running for a generation that failed
+        for task in file_tasks:
+            task.cancel()
+        raise
+    
+    # Generate file hierarchy
+    file_hierarchy = generate_file_hierarchy(processed_files)
+    
+    result = {
+        "files": list(processed_files),
+        "explanation": metadata.get("explanation", "Infrastructure code generated successfully."),
+        "resources": metadata.get("resources", []),
+        "estimated_cost": metadata.get("estimated_cost", "Unknown"),
+        "file_hierarchy": file_hierarchy,  # Now properly generated
+        "is_valid_request": True,
+        "architecture_diagram": architecture_diagram
+    }
+    return result
+
+async def call_ai_model(description: str, provider: str, include_diagram: bool = True, conversation_history: List[dict] = [], normalized_description: Optional[str] = None):
+    """Enhanced AI model call with dynamic file processing and multi-turn conversation support"""
+    # Invalid descriptions are rejected by the caller (/api/generate) before any of this runs
+    if normalized_description is None:
+        normalized_description = normalize_description(description)
+    
+    # Only use cache for single-turn (no conversation history)
+    cache_key = generation_cache_key(normalized_description, provider, include_diagram)
+    cached_data = None if conversation_history else get_cached_generation(cache_key)
+    if cached_data is not None:
+        return cached_data
+
+    try:
+        if conversation_history:
+            result = await run_limited_generation(description, provider, include_diagram, conversation_history)
+            joined = False
+        else:
+            # Concurrent identical single-turn requests share one in-flight generation, which caches
+            # its own result. Multi-turn results depend on the conversation, so they are never cached
+            pending = get_inflight_generation(cache_key)
+            joined = pending is not None
+            if not joined:
+                pending = start_shared_generation(cache_key, description, provider, include_diagram)
+            # Shield so one caller disconnecting doesn't cancel the generation for the others
+            result = await asyncio.shield(pending)
         
-        response_cache[cache_key] = result.copy()
-        result["cached_response"] = False
+        result = result.copy()
+        result["cached_response"] = joined
         return result
 
     except Exception as e:
-        print(f"ERROR: AI generation failed: {e}")
+        logger.warning("AI generation failed: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
                           detail=f"AI generation failed: {str(e)}")
 
@@ -758,12 +881,16 @@ Optionally include additional files as needed:
 #    - Add a foreign key constraint from `generations.user_id` to `users.id`.
 #    - Add a composite index on `(user_id, created_at)`.
 
+async def run_query(query):
+    """Execute a Supabase query in a worker thread so the blocking HTTP call doesn't stall the event loop"""
+    return await asyncio.to_thread(query.execute)
+
 async def create_user(email: str, name: str, password: str):
     """Create a new user in Supabase using admin privileges"""
     try:
         # Use Supabase's admin method to create a user.
         # This requires the Supabase client to be initialized with the service_role key.
-        user = supabase.auth.admin.create_user({
+        user = await asyncio.to_thread(supabase.auth.admin.create_user, {
             "email": email.lower(),
             "password": password,
             "email_confirm": True,  # Auto-confirm the user
@@ -771,36 +898,37 @@ async def create_user(email: str, name: str, password: str):
         })
         return user
     except Exception as e:
-        print(f"Supabase admin create_user error: {e}")
+        logger.warning("Supabase admin create_user error: %s", e)
         return None
 
 async def get_user_by_email(email: str):
     """Get user by email from Supabase"""
     try:
-        result = supabase.table("users").select("*").eq("email", email.lower()).execute()
+        result = await run_query(supabase.table("users").select("*").eq("email", email.lower()))
         if result.data:
             return result.data[0]
         return None
     except Exception as e:
-        print(f"Database error getting user: {e}")
+        logger.warning("Database error getting user: %s", e)
         return None
 
 async def get_user_by_id(user_id: str):
     """Get user by ID from Supabase"""
     try:
-        result = supabase.table("users").select("*").eq("id", user_id).execute()
+        result = await run_query(supabase.table("users").select("*").eq("id", user_id))
         if result.data:
             return result.data[0]
+        _missing_user_cache[user_id] = True
         return None
     except Exception as e:
-        print(f"Database error getting user by ID: {e}")
+        logger.warning("Database error getting user by ID: %s", e)
         return None
 
 async def check_quota(user_id: str) -> bool:
     """Check if the user has reached their monthly free generation limit."""
     try:
         # Check plan
-        sub_result = supabase.table("subscriptions").select("plan").eq("user_id", user_id).execute()
+        sub_result = await run_query(supabase.table("subscriptions").select("plan").eq("user_id", user_id))
         plan = "free"
         if sub_result.data:
             plan = sub_result.data[0].get("plan", "free")
@@ -810,14 +938,14 @@ async def check_quota(user_id: str) -> bool:
             
         # Check usage for current month
         current_month = datetime.utcnow().strftime('%Y-%m')
-        usage_result = supabase.table("usage").select("generation_count").eq("user_id", user_id).eq("month", current_month).execute()
+        usage_result = await run_query(supabase.table("usage").select("generation_count").eq("user_id", user_id).eq("month", current_month))
         
         if usage_result.data and usage_result.data[0].get("generation_count", 0) >= 5:
             return False
             
         return True
     except Exception as e:
-        print(f"Error checking quota: {e}")
+        logger.warning("Error checking quota: %s", e)
         return True # Default to allow on error so we don't block users if DB fails briefly
 
 async def increment_usage(user_id: str):
@@ -825,16 +953,16 @@ async def increment_usage(user_id: str):
     try:
         current_month = datetime.utcnow().strftime('%Y-%m')
         # Use the RPC function created in the SQL schema
-        supabase.rpc('increment_usage_count', {'p_user_id': user_id, 'p_month': current_month}).execute()
+        await run_query(supabase.rpc('increment_usage_count', {'p_user_id': user_id, 'p_month': current_month}))
     except Exception as e:
-        print(f"Error incrementing usage: {e}")
+        logger.warning("Error incrementing usage: %s", e)
 
 async def save_generation(user_id: str, request: GenerateRequest, response: GenerateResponse, parent_id: str = None, org_id: str = None):
     """Save a generation to the database."""
     try:
         # Convert files list to JSON string for the 'code' column (matches DB schema)
         files_list = [file.dict() for file in response.files]
-        files_as_json = json.dumps(files_list)
+        files_as_json = orjson.dumps(files_list).decode()
         generation_data = {
             "user_id": user_id,
             "description": request.description,
@@ -853,14 +981,14 @@ async def save_generation(user_id: str, request: GenerateRequest, response: Gene
         # Add optional org_id for team workspaces
         if org_id:
             generation_data["org_id"] = org_id
-        print(f"Saving generation for user {user_id}...")
-        result = supabase.table("generations").insert(generation_data).execute()
-        print(f"Generation saved successfully: {result.data[0]['id'] if result.data else 'no data'}")
+        logger.debug("Saving generation for user %s...", user_id)
+        result = await run_query(supabase.table("generations").insert(generation_data))
+        logger.debug("Generation saved successfully: %s", result.data[0]['id'] if result.data else 'no data')
         if result.data:
             return result.data[0]
         return None
     except Exception as e:
-        print(f"Database error saving generation: {e}")
+        logger.exception("Database error saving generation: %s", e)
         return None
 
 
@@ -868,30 +996,69 @@ async def save_generation(user_id: str, request: GenerateRequest, response: Gene
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
+    # Integer epoch seconds, which is what PyJWT would turn a datetime into anyway
+    expire = int(time.time()) + int((expires_delta or timedelta(minutes=15)).total_seconds())
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    return jwt.encode(to_encode, JWT_SIGNING_KEY, algorithm=ALGORITHM)
+
+# get_user_by_id lookups currently running, so a burst of requests that all miss _user_cache
+# for the same user share one Supabase query
+_inflight_user_lookups: Dict[str, asyncio.Task] = {}
+
+def _forget_inflight_user_lookup(user_id: str, task: asyncio.Task):
+    if _inflight_user_lookups.get(user_id) is task:
+        del _inflight_user_lookups[user_id]
+
+async def load_user(user_id: str) -> Optional[dict]:
+    loop = asyncio.get_running_loop()
+    pending = _inflight_user_lookups.get(user_id)
+    if pending is None or pending.get_loop() is not loop:
+        pending = loop.create_task(get_user_by_id(user_id))
+        _inflight_user_lookups[user_id] = pending
+        pending.add_done_callback(lambda task: _forget_inflight_user_lookup(user_id, task))
+    # Shield so one caller disconnecting doesn't cancel the lookup for the others
+    return await asyncio.shield(pending)
+
+async def get_current_user(request: Request):
+    # Read the bearer token straight from the header instead of going through HTTPBearer
+    # The scheme is case-insensitive (RFC 7235), as it was under HTTPBearer
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated.")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = _jwt_cache.get(token_key)
+        if cached and cached.get("exp", 0) > time.time():
+            payload = cached
+        else:
+            payload = jwt_decoder.decode(token, JWT_VERIFYING_KEY, algorithms=[ALGORITHM])
+            _jwt_cache[token_key] = payload
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token.")
         
-        user = await get_user_by_id(user_id)
-        if not user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found.")
+        user = _user_cache.get(user_id)
+        if user is None:
+            if user_id in _missing_user_cache:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found.")
+            user = await load_user(user_id)
+            if not user:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found.")
+            _user_cache[user_id] = user
         
         return user
     except PyJWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials.")
 
 # --- Routes ---
+# Static response bodies are encoded once at import and served as raw bytes
+_ROOT_JSON = json.dumps({"message": "TerraformCoder AI API is running with enhanced features and Mermaid Chart integration!"}).encode()
+_HEALTH_JSON_PREFIX = b'{"status": "healthy", "timestamp": "'
+_HEALTH_JSON_SUFFIX = b'"}'
+
 @app.get("/")
 def root():
-    return {"message": "TerraformCoder AI API is running with enhanced features and Mermaid Chart integration!"}
+    return Response(content=_ROOT_JSON, media_type="application/json")
 
 class RegisterRequest(BaseModel):
     email: str
@@ -910,15 +1077,15 @@ class AuthResponse(BaseModel):
 
 @app.post("/api/auth/register", response_model=AuthResponse)
 async def register(request: RegisterRequest):
-    print(f"Attempting to register user: {request.email}")
+    logger.info("Attempting to register user: %s", request.email)
     existing_user = await get_user_by_email(request.email)
     if existing_user:
-        print(f"User {request.email} already exists.")
+        logger.info("User %s already exists.", request.email)
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User already exists.")
 
     # 1. Create the user in Supabase Auth
     try:
-        response = supabase.auth.sign_up({
+        response = await asyncio.to_thread(supabase.auth.sign_up, {
             "email": request.email.lower(),
             "password": request.password,
             "options": {
@@ -928,22 +1095,23 @@ async def register(request: RegisterRequest):
         if not response or not response.user:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to create auth user.")
     except Exception as e:
-        print(f"Error creating auth user: {e}")
+        logger.warning("Error creating auth user: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
     auth_user = response.user
-    print(f"Auth user for {request.email} created successfully.")
+    logger.info("Auth user for %s created successfully.", request.email)
 
     user_id = str(auth_user.id)
 
     # 2. Create access token
     token = create_access_token({"sub": user_id})
 
-    # 3. Return response
-    return AuthResponse(
+    # 3. Return response (server-built, so skip input validation)
+    return AuthResponse.model_construct(
         message="User registered successfully",
         user={"id": user_id, "email": request.email, "name": request.name},
-        access_token=token
+        access_token=token,
+        token_type="bearer"
     )
 
 @app.post("/api/auth/login", response_model=AuthResponse)
@@ -952,114 +1120,199 @@ async def login(request: LoginRequest):
     Logs in a user using Supabase Auth.
     """
     try:
-        response = supabase.auth.sign_in_with_password({
+        response = await asyncio.to_thread(supabase.auth.sign_in_with_password, {
             "email": request.email.lower(),
             "password": request.password,
         })
 
         if response.user and response.session:
-            user_data = response.user.dict()
+            # Read fields straight off the user model rather than dumping the whole thing with .dict()
+            auth_user = response.user
+            user_id = str(auth_user.id)
             # Supabase user metadata is in user_metadata
-            user_name = user_data.get("user_metadata", {}).get("name", "User")
+            user_name = (auth_user.user_metadata or {}).get("name", "User")
             
-            token = create_access_token({"sub": str(user_data["id"])})
+            token = create_access_token({"sub": user_id})
 
-            return AuthResponse(
+            return AuthResponse.model_construct(
                 message="Login successful",
-                user={"id": str(user_data["id"]), "email": user_data["email"], "name": user_name},
-                access_token=token
+                user={"id": user_id, "email": auth_user.email or "", "name": user_name},
+                access_token=token,
+                token_type="bearer"
             )
         else:
             # Handle cases where sign_in_with_password doesn't return user/session but no exception
-            print(f"Supabase sign_in_with_password response: {response}")
+            logger.warning("Supabase sign_in_with_password response: %s", response)
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials.")
 
     except Exception as e:
-        print(f"Supabase Auth sign_in_with_password error: {e}")
+        logger.warning("Supabase Auth sign_in_with_password error: %s", e)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials.")
 
+def invalid_generate_response(provider: str) -> GenerateResponse:
+    """Response for descriptions that don't look like an infrastructure request"""
+    return GenerateResponse.model_construct(
+        files=[],
+        explanation="⚠️ Please provide a clear description of your cloud infrastructure requirements.",
+        resources=[],
+        estimated_cost="Unknown",
+        provider=provider,
+        generated_at=utc_now_iso(),
+        cached_response=False,
+        file_hierarchy="",
+        is_valid_request=False
+    )
+
+async def finalize_generation(request: GenerateRequest, current_user: Dict, result: Dict) -> GenerateResponse:
+    """Build the GenerateResponse for a pipeline result, save it and count it against the user's quota"""
+    # Build the response object without the ID first; every field is already a validated
+    # model or plain value from the pipeline, so skip re-validating it here
+    response_obj = GenerateResponse.model_construct(
+        files=result["files"],
+        explanation=result["explanation"],
+        resources=result["resources"],
+        estimated_cost=result["estimated_cost"],
+        provider=request.provider,
+        generated_at=utc_now_iso(),
+        cached_response=result.get("cached_response", False),
+        file_hierarchy=result["file_hierarchy"],
+        is_valid_request=result.get("is_valid_request", True),
+        architecture_diagram=result.get("architecture_diagram")
+    )
+    logger.debug("Response object built, saving to DB...")
+    
+    # Determine parent_id for conversation threading
+    parent_id = request.parent_generation_id if request.parent_generation_id else None
+
+    # Determine org_id for team workspaces
+    org_id = None
+    try:
+        membership = await run_query(supabase.table("org_members").select("org_id").eq("user_id", current_user["id"]).limit(1))
+        if membership.data:
+            org_id = membership.data[0]["org_id"]
+    except Exception:
+        pass  # org_members table may not exist yet
+
+    # Save the generation to Supabase
+    saved_generation = await save_generation(current_user["id"], request, response_obj, parent_id=parent_id, org_id=org_id)
+    
+    # Increment usage count after successful generation
+    await increment_usage(current_user["id"])
+    
+    # Add the ID to the response if it was successfully saved
+    if saved_generation and "id" in saved_generation:
+        response_obj.id = saved_generation["id"]
+    return response_obj
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Events message with a JSON payload"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
 @app.post("/api/generate", response_model=GenerateResponse)
 async def generate(request: GenerateRequest, current_user: Dict = Depends(get_current_user)):
-    print(f"=== GENERATE START === user={current_user.get('id')} desc={request.description[:50]}")
+    logger.debug("=== GENERATE START === user=%s desc=%s", current_user.get('id'), request.description[:50])
     try:
-        if not request.description.strip():
+        # Normalize once for both checks; rejections return before any awaits
+        normalized_description = normalize_description(request.description)
+        if not normalized_description:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Description cannot be empty.")
 
-        if not is_valid_infrastructure_request(request.description):
-            print("Invalid infrastructure request")
-            return GenerateResponse(
-                files=[],
-                explanation="⚠️ Please provide a clear description of your cloud infrastructure requirements.",
-                resources=[],
-                estimated_cost="Unknown",
-                provider=request.provider,
-                generated_at=datetime.utcnow().isoformat(),
-                cached_response=False,
-                file_hierarchy="",
-                is_valid_request=False
-            )
+        if not is_valid_infrastructure_request(request.description, normalized_description):
+            logger.debug("Invalid infrastructure request")
+            return invalid_generate_response(request.provider)
 
         # Enforce Quota
-        print("Checking quota...")
+        logger.debug("Checking quota...")
         has_quota = await check_quota(current_user["id"])
         if not has_quota:
             raise HTTPException(status_code=429, detail="Monthly generation limit reached. Upgrade to Pro for unlimited generations.")
-        print("Quota OK, calling AI model...")
+        logger.debug("Quota OK, calling AI model...")
 
         # Build conversation history for multi-turn
         conv_history = [msg.dict() for msg in request.conversation_history] if request.conversation_history else []
 
-        result = await call_ai_model(request.description, request.provider, request.include_diagram, conversation_history=conv_history)
-        print(f"AI model returned {len(result.get('files', []))} files")
-        
-        # Build the response object without the ID first
-        response_obj = GenerateResponse(
-            files=result["files"],
-            explanation=result["explanation"],
-            resources=result["resources"],
-            estimated_cost=result["estimated_cost"],
-            provider=request.provider,
-            generated_at=datetime.utcnow().isoformat(),
-            cached_response=result.get("cached_response", False),
-            file_hierarchy=result["file_hierarchy"],
-            is_valid_request=result.get("is_valid_request", True),
-            architecture_diagram=result.get("architecture_diagram")
-        )
-        print("Response object built, saving to DB...")
-        
-        # Determine parent_id for conversation threading
-        parent_id = request.parent_generation_id if request.parent_generation_id else None
-
-        # Determine org_id for team workspaces
-        org_id = None
-        try:
-            membership = supabase.table("org_members").select("org_id").eq("user_id", current_user["id"]).limit(1).execute()
-            if membership.data:
-                org_id = membership.data[0]["org_id"]
-        except Exception:
-            pass  # org_members table may not exist yet
-
-        # Save the generation to Supabase
-        saved_generation = await save_generation(current_user["id"], request, response_obj, parent_id=parent_id, org_id=org_id)
+        result = await call_ai_model(request.description, request.provider, request.include_diagram, conversation_history=conv_history, normalized_description=normalized_description)
+        logger.debug("AI model returned %d files", len(result.get('files', [])))
         
-        # Increment usage count after successful generation
-        await increment_usage(current_user["id"])
-        
-        # Add the ID to the response if it was successfully saved
-        if saved_generation and "id" in saved_generation:
-            response_obj.id = saved_generation["id"]
-        
-        print(f"=== GENERATE SUCCESS ===")
+        response_obj = await finalize_generation(request, current_user, result)
+        logger.debug("=== GENERATE SUCCESS ===")
         return response_obj
     except HTTPException:
         raise
     except Exception as e:
-        print(f"=== GENERATE CRASHED === {traceback.format_exc()}")
+        logger.exception("=== GENERATE CRASHED ===")
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+@app.post("/api/generate/stream")
+async def generate_stream(request: GenerateRequest, current_user: Dict = Depends(get_current_user)):
+    """Like /api/generate, but streams the model's output as Server-Sent Events while it is written"""
+    # Events: `delta` ({"text": ...}) for each chunk of raw model output, then exactly one `result`
+    # (the GenerateResponse JSON) or `error` ({"detail": ...}).
+    normalized_description = normalize_description(request.description)
+    if not normalized_description:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Description cannot be empty.")
+
+    # Quota is checked before the stream starts so it can still be a plain 429
+    is_valid = is_valid_infrastructure_request(request.description, normalized_description)
+    if is_valid and not await check_quota(current_user["id"]):
+        raise HTTPException(status_code=429, detail="Monthly generation limit reached. Upgrade to Pro for unlimited generations.")
+
+    conv_history = [msg.dict() for msg in request.conversation_history] if request.conversation_history else []
+
+    async def events():
+        if not is_valid:
+            yield sse_event("result", invalid_generate_response(request.provider).model_dump(mode="json"))
+            return
+
+        cache_key = generation_cache_key(normalized_description, request.provider, request.include_diagram)
+        task = None
+        try:
+            result = None if conv_history else get_cached_generation(cache_key)
+            pending = None if conv_history or result is not None else get_inflight_generation(cache_key)
+            if pending is not None:
+                # An identical generation is already running (e.g. for /api/generate): join it. Its
+                # output is already being consumed elsewhere, so there are no deltas to relay
+                result = (await asyncio.shield(pending)).copy()
+                result["cached_response"] = True
+            elif result is None:
+                deltas: asyncio.Queue = asyncio.Queue()
+                if conv_history:
+                    task = asyncio.create_task(run_limited_generation(
+                        request.description, request.provider, request.include_diagram, conv_history, on_delta=deltas.put_nowait
+                    ))
+                else:
+                    # Registered like call_ai_model's, so identical /api/generate requests join this one
+                    task = start_shared_generation(
+                        cache_key, request.description, request.provider, request.include_diagram, on_delta=deltas.put_nowait
+                    )
+                task.add_done_callback(lambda _: deltas.put_nowait(None))
+                while (delta := await deltas.get()) is not None:
+                    yield sse_event("delta", {"text": delta})
+                # Shield so closing this stream never cancels a generation others may have joined
+                result = (await asyncio.shield(task)).copy()
+            response_obj = await finalize_generation(request, current_user, result)
+            yield sse_event("result", response_obj.model_dump(mode="json"))
+        except Exception as e:
+            logger.exception("=== GENERATE STREAM CRASHED ===")
+            yield sse_event("error", {"detail": f"Generation failed: {str(e)}"})
+        finally:
+            # The client went away mid-stream: stop a multi-turn generation instead of finishing it
+            # for nobody. A shared single-turn one keeps running for any joined requests and the cache
+            if task is not None and conv_history and not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return Response(
+        content=_HEALTH_JSON_PREFIX + utc_now_iso().encode() + _HEALTH_JSON_SUFFIX,
+        media_type="application/json"
+    )
 
 class GenerationHistory(BaseModel):
     id: str
@@ -1071,15 +1324,16 @@ class GenerationHistory(BaseModel):
 @app.get("/api/history", response_model=List[GenerationHistory])
 async def get_history(limit: int = 20, offset: int = 0, current_user: Dict = Depends(get_current_user)):
     try:
-        response = supabase.table("generations") \
-            .select("id, description, provider, estimated_cost, created_at") \
-            .eq("user_id", current_user["id"]) \
-            .order("created_at", desc=True) \
-            .range(offset, offset + limit - 1) \
-            .execute()
+        response = await run_query(
+            supabase.table("generations")
+            .select("id, description, provider, estimated_cost, created_at")
+            .eq("user_id", current_user["id"])
+            .order("created_at", desc=True)
+            .range(offset, offset + limit - 1)
+        )
         return response.data
     except Exception as e:
-        print(f"Error fetching history: {e}")
+        logger.warning("Error fetching history: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch generation history.")
 
 @app.get("/api/history/team")
@@ -1087,36 +1341,39 @@ async def get_team_history(org_id: str, limit: int = 20, offset: int = 0, curren
     """Get generation history for a team/org."""
     try:
         # Verify membership
-        membership = supabase.table("org_members") \
-            .select("role") \
-            .eq("org_id", org_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        membership = await run_query(
+            supabase.table("org_members")
+            .select("role")
+            .eq("org_id", org_id)
+            .eq("user_id", current_user["id"])
+        )
 
         if not membership.data:
             raise HTTPException(status_code=403, detail="Not a member of this organization.")
 
-        response = supabase.table("generations") \
-            .select("id, description, provider, estimated_cost, created_at") \
-            .eq("org_id", org_id) \
-            .order("created_at", desc=True) \
-            .range(offset, offset + limit - 1) \
-            .execute()
+        response = await run_query(
+            supabase.table("generations")
+            .select("id, description, provider, estimated_cost, created_at")
+            .eq("org_id", org_id)
+            .order("created_at", desc=True)
+            .range(offset, offset + limit - 1)
+        )
         return response.data
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching team history: {e}")
+        logger.warning("Error fetching team history: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch team history.")
 
 @app.get("/api/history/{generation_id}", response_model=GenerateResponse)
 async def get_generation_by_id(generation_id: str, current_user: Dict = Depends(get_current_user)):
     try:
-        response = supabase.table("generations") \
-            .select("*") \
-            .eq("id", generation_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        response = await run_query(
+            supabase.table("generations")
+            .select("*")
+            .eq("id", generation_id)
+            .eq("user_id", current_user["id"])
+        )
             
         if not response.data:
             raise HTTPException(status_code=404, detail="Generation not found or access denied.")
@@ -1155,17 +1412,18 @@ async def get_generation_by_id(generation_id: str, current_user: Dict = Depends(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching generation {generation_id}: {e}")
+        logger.warning("Error fetching generation %s: %s", generation_id, e)
         raise HTTPException(status_code=500, detail="Failed to fetch generation details.")
 
 @app.get("/api/download/{generation_id}")
 async def download_generation_zip(generation_id: str, current_user: Dict = Depends(get_current_user)):
     try:
-        response = supabase.table("generations") \
-            .select("files, code, description, provider") \
-            .eq("id", generation_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        response = await run_query(
+            supabase.table("generations")
+            .select("files, code, description, provider")
+            .eq("id", generation_id)
+            .eq("user_id", current_user["id"])
+        )
             
         if not response.data:
             raise HTTPException(status_code=404, detail="Generation not found or access denied.")
@@ -1180,7 +1438,7 @@ async def download_generation_zip(generation_id: str, current_user: Dict = Depen
                 if isinstance(parsed, list):
                     files = parsed
             except Exception as parse_err:
-                print(f"Warning: Could not parse code column: {parse_err}")
+                logger.warning("Could not parse code column: %s", parse_err)
                 files = []
         
         if not files:
@@ -1215,7 +1473,7 @@ async def download_generation_zip(generation_id: str, current_user: Dict = Depen
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error creating ZIP for generation {generation_id}: {e}")
+        logger.warning("Error creating ZIP for generation %s: %s", generation_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to create ZIP file: {str(e)}")
 
 # --- Feature 1: Shareable Generation Links ---
@@ -1225,11 +1483,12 @@ async def toggle_share_generation(generation_id: str, current_user: Dict = Depen
     """Toggle sharing for a generation. Only the owner can share/unshare."""
     try:
         # Verify ownership
-        gen_result = supabase.table("generations") \
-            .select("id, is_public, slug") \
-            .eq("id", generation_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        gen_result = await run_query(
+            supabase.table("generations")
+            .select("id, is_public, slug")
+            .eq("id", generation_id)
+            .eq("user_id", current_user["id"])
+        )
 
         if not gen_result.data:
             raise HTTPException(status_code=404, detail="Generation not found or access denied.")
@@ -1238,18 +1497,18 @@ async def toggle_share_generation(generation_id: str, current_user: Dict = Depen
 
         if gen.get("is_public"):
             # Unshare: set is_public=False, slug=None
-            supabase.table("generations").update({
+            await run_query(supabase.table("generations").update({
                 "is_public": False,
                 "slug": None
-            }).eq("id", generation_id).execute()
+            }).eq("id", generation_id))
             return {"shared": False}
         else:
             # Share: generate slug, set is_public=True
             slug = secrets.token_urlsafe(10)
-            supabase.table("generations").update({
+            await run_query(supabase.table("generations").update({
                 "is_public": True,
                 "slug": slug
-            }).eq("id", generation_id).execute()
+            }).eq("id", generation_id))
             return {
                 "shared": True,
                 "slug": slug,
@@ -1258,18 +1517,19 @@ async def toggle_share_generation(generation_id: str, current_user: Dict = Depen
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error toggling share for {generation_id}: {e}")
+        logger.warning("Error toggling share for %s: %s", generation_id, e)
         raise HTTPException(status_code=500, detail=f"Failed to toggle share: {str(e)}")
 
 @app.get("/api/share/{slug}")
 async def get_shared_generation(slug: str):
     """Get a publicly shared generation by slug — NO authentication required."""
     try:
-        response = supabase.table("generations") \
-            .select("id, files, explanation, architecture_diagram, provider, description, created_at, resources, estimated_cost, file_hierarchy") \
-            .eq("slug", slug) \
-            .eq("is_public", True) \
-            .execute()
+        response = await run_query(
+            supabase.table("generations")
+            .select("id, files, explanation, architecture_diagram, provider, description, created_at, resources, estimated_cost, file_hierarchy")
+            .eq("slug", slug)
+            .eq("is_public", True)
+        )
 
         if not response.data:
             raise HTTPException(status_code=404, detail="Shared generation not found.")
@@ -1299,7 +1559,7 @@ async def get_shared_generation(slug: str):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching shared generation {slug}: {e}")
+        logger.warning("Error fetching shared generation %s: %s", slug, e)
         raise HTTPException(status_code=500, detail="Failed to fetch shared generation.")
 
 # --- Feature 3: Team Workspaces ---
@@ -1317,11 +1577,11 @@ async def create_org(request: CreateOrgRequest, current_user: Dict = Depends(get
     """Create a new organization and add the creator as admin."""
     try:
         # Create the org
-        org_result = supabase.table("organizations").insert({
+        org_result = await run_query(supabase.table("organizations").insert({
             "name": request.name,
             "slug": request.slug,
             "owner_id": current_user["id"],
-        }).execute()
+        }))
 
         if not org_result.data:
             raise HTTPException(status_code=500, detail="Failed to create organization.")
@@ -1329,27 +1589,28 @@ async def create_org(request: CreateOrgRequest, current_user: Dict = Depends(get
         org = org_result.data[0]
 
         # Auto-add creator as admin member
-        supabase.table("org_members").insert({
+        await run_query(supabase.table("org_members").insert({
             "org_id": org["id"],
             "user_id": current_user["id"],
             "role": "admin",
-        }).execute()
+        }))
 
         return org
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error creating org: {e}")
+        logger.warning("Error creating org: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create organization: {str(e)}")
 
 @app.get("/api/orgs/me")
 async def get_my_orgs(current_user: Dict = Depends(get_current_user)):
     """Return organizations the current user belongs to, with their role."""
     try:
-        members = supabase.table("org_members") \
-            .select("org_id, role, organizations(id, name, slug, owner_id, plan, created_at)") \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        members = await run_query(
+            supabase.table("org_members")
+            .select("org_id, role, organizations(id, name, slug, owner_id, plan, created_at)")
+            .eq("user_id", current_user["id"])
+        )
 
         results = []
         for m in members.data:
@@ -1365,7 +1626,7 @@ async def get_my_orgs(current_user: Dict = Depends(get_current_user)):
             })
         return results
     except Exception as e:
-        print(f"Error fetching user orgs: {e}")
+        logger.warning("Error fetching user orgs: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch organizations.")
 
 @app.post("/api/orgs/{org_id}/invite")
@@ -1373,11 +1634,12 @@ async def invite_to_org(org_id: str, request: InviteRequest, current_user: Dict
     """Invite a user to an org. Only admins can invite."""
     try:
         # Verify caller is admin
-        membership = supabase.table("org_members") \
-            .select("role") \
-            .eq("org_id", org_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        membership = await run_query(
+            supabase.table("org_members")
+            .select("role")
+            .eq("org_id", org_id)
+            .eq("user_id", current_user["id"])
+        )
 
         if not membership.data or membership.data[0]["role"] != "admin":
             raise HTTPException(status_code=403, detail="Only admins can invite members.")
@@ -1386,13 +1648,13 @@ async def invite_to_org(org_id: str, request: InviteRequest, current_user: Dict
         token = secrets.token_urlsafe(32)
         expires_at = (datetime.utcnow() + timedelta(days=7)).isoformat()
 
-        supabase.table("invites").insert({
+        await run_query(supabase.table("invites").insert({
             "org_id": org_id,
             "email": request.email.lower(),
             "role": request.role,
             "token": token,
             "expires_at": expires_at,
-        }).execute()
+        }))
 
         accept_url = f"https://terraformcoder-ai.vercel.app/accept-invite/{token}"
 
@@ -1404,18 +1666,19 @@ async def invite_to_org(org_id: str, request: InviteRequest, current_user: Dict
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error creating invite: {e}")
+        logger.warning("Error creating invite: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create invite: {str(e)}")
 
 @app.get("/api/orgs/accept-invite/{token}")
 async def accept_invite(token: str, current_user: Dict = Depends(get_current_user)):
     """Accept an org invite. The invite token must be valid and not expired."""
     try:
-        invite_result = supabase.table("invites") \
-            .select("*") \
-            .eq("token", token) \
-            .is_("accepted_at", "null") \
-            .execute()
+        invite_result = await run_query(
+            supabase.table("invites")
+            .select("*")
+            .eq("token", token)
+            .is_("accepted_at", "null")
+        )
 
         if not invite_result.data:
             raise HTTPException(status_code=404, detail="Invite not found or already accepted.")
@@ -1428,23 +1691,24 @@ async def accept_invite(token: str, current_user: Dict = Depends(get_current_use
             raise HTTPException(status_code=400, detail="Invite has expired.")
 
         # Upsert member
-        supabase.table("org_members").upsert({
+        await run_query(supabase.table("org_members").upsert({
             "org_id": invite["org_id"],
             "user_id": current_user["id"],
             "role": invite["role"],
             "invited_by": None,  # Could track the inviter if needed
-        }).execute()
+        }))
 
         # Mark invite as accepted
-        supabase.table("invites").update({
+        await run_query(supabase.table("invites").update({
             "accepted_at": datetime.utcnow().isoformat()
-        }).eq("id", invite["id"]).execute()
+        }).eq("id", invite["id"]))
 
         # Fetch org details to return
-        org_result = supabase.table("organizations") \
-            .select("*") \
-            .eq("id", invite["org_id"]) \
-            .execute()
+        org_result = await run_query(
+            supabase.table("organizations")
+            .select("*")
+            .eq("id", invite["org_id"])
+        )
 
         return {
             "message": "Invite accepted successfully",
@@ -1453,7 +1717,7 @@ async def accept_invite(token: str, current_user: Dict = Depends(get_current_use
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error accepting invite: {e}")
+        logger.warning("Error accepting invite: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to accept invite: {str(e)}")
 
 @app.get("/api/orgs/{org_id}/members")
@@ -1461,31 +1725,37 @@ async def get_org_members(org_id: str, current_user: Dict = Depends(get_current_
     """Return all members of an organization with their roles."""
     try:
         # Verify caller is a member
-        membership = supabase.table("org_members") \
-            .select("role") \
-            .eq("org_id", org_id) \
-            .eq("user_id", current_user["id"]) \
-            .execute()
+        membership = await run_query(
+            supabase.table("org_members")
+            .select("role")
+            .eq("org_id", org_id)
+            .eq("user_id", current_user["id"])
+        )
 
         if not membership.data:
             raise HTTPException(status_code=403, detail="Not a member of this organization.")
 
         # Get all members
-        members_result = supabase.table("org_members") \
-            .select("user_id, role, joined_at") \
-            .eq("org_id", org_id) \
-            .execute()
+        members_result = await run_query(
+            supabase.table("org_members")
+            .select("user_id, role, joined_at")
+            .eq("org_id", org_id)
+        )
 
-        # Enrich with user email from auth (using admin client)
+        # Enrich with user email from auth (using admin client); the lookups run concurrently
+        # in worker threads instead of one blocking call after another
+        auth_users = await asyncio.gather(
+            *(asyncio.to_thread(supabase.auth.admin.get_user_by_id, member["user_id"]) for member in members_result.data),
+            return_exceptions=True
+        )
         enriched = []
-        for member in members_result.data:
-            try:
-                user = supabase.auth.admin.get_user_by_id(member["user_id"])
-                email = user.user.email if user and user.user else "unknown"
-                name = (user.user.user_metadata or {}).get("name", "") if user and user.user else ""
-            except Exception:
+        for member, user in zip(members_result.data, auth_users):
+            if isinstance(user, Exception):
                 email = "unknown"
                 name = ""
+            else:
+                email = user.user.email if user and user.user else "unknown"
+                name = (user.user.user_metadata or {}).get("name", "") if user and user.user else ""
             enriched.append({
                 "user_id": member["user_id"],
                 "role": member["role"],
@@ -1498,7 +1768,7 @@ async def get_org_members(org_id: str, current_user: Dict = Depends(get_current_
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching org members: {e}")
+        logger.warning("Error fetching org members: %s", e)
         raise HTTPException(status_code=500, detail="Failed to fetch organization members.")
 
 @app.post("/api/billing/checkout")
@@ -1520,7 +1790,7 @@ async def create_checkout_session(current_user: Dict = Depends(get_current_user)
         )
         return {"checkout_url": session.url}
     except Exception as e:
-        print(f"Stripe checkout error: {e}")
+        logger.warning("Stripe checkout error: %s", e)
         raise HTTPException(status_code=500, detail="Failed to create checkout session.")
 
 from fastapi import Request
@@ -1539,10 +1809,10 @@ async def stripe_webhook(request: Request):
             payload, sig_header, endpoint_secret
         )
     except ValueError as e:
-        print(f"Invalid payload: {e}")
+        logger.warning("Invalid payload: %s", e)
         return Response(content="Invalid payload", status_code=400)
     except stripe.error.SignatureVerificationError as e:
-        print(f"Invalid signature: {e}")
+        logger.warning("Invalid signature: %s", e)
         return Response(content="Invalid signature", status_code=400)
 
     # Handle the checkout.session.completed event
@@ -1556,16 +1826,16 @@ async def stripe_webhook(request: Request):
         if user_id:
             try:
                 # Upsert subscription
-                supabase.table("subscriptions").upsert({
+                await run_query(supabase.table("subscriptions").upsert({
                     "user_id": user_id,
                     "stripe_customer_id": customer_id,
                     "stripe_subscription_id": subscription_id,
                     "plan": "pro",
                     "status": "active"
-                }).execute()
-                print(f"Successfully upgraded user {user_id} to pro.")
+                }))
+                logger.info("Successfully upgraded user %s to pro.", user_id)
             except Exception as e:
-                print(f"Error updating subscription in DB: {e}")
+                logger.warning("Error updating subscription in DB: %s", e)
                 
     return Response(content="success")
 
@@ -1573,14 +1843,14 @@ async def stripe_webhook(request: Request):
 async def get_billing_status(current_user: Dict = Depends(get_current_user)):
     try:
         # Get plan
-        sub_result = supabase.table("subscriptions").select("plan").eq("user_id", current_user["id"]).execute()
+        sub_result = await run_query(supabase.table("subscriptions").select("plan").eq("user_id", current_user["id"]))
         plan = "free"
         if sub_result.data:
             plan = sub_result.data[0].get("plan", "free")
             
         # Get usage
         current_month = datetime.utcnow().strftime('%Y-%m')
-        usage_result = supabase.table("usage").select("generation_count").eq("user_id", current_user["id"]).eq("month", current_month).execute()
+        usage_result = await run_query(supabase.table("usage").select("generation_count").eq("user_id", current_user["id"]).eq("month", current_month))
         
         generation_count = 0
         if usage_result.data:
@@ -1592,7 +1862,7 @@ async def get_billing_status(current_user: Dict = Depends(get_current_user)):
             "limit": 5 if plan == "free" else -1
         }
     except Exception as e:
-        print(f"Error fetching billing status: {e}")
+        logger.warning("Error fetching billing status: %s", e)
         # Default to free tier on error to be safe
         return {
             "plan": "free",
@@ -1615,7 +1885,7 @@ async def generate_diagram(request: GenerateRequest, current_user: Dict = Depend
             "diagram": architecture_diagram.dict(),
             "message": "Architecture diagram generated successfully",
             "mermaid_chart_url": architecture_diagram.mermaid_chart_url,
-            "generated_at": datetime.utcnow().isoformat()
+            "generated_at": utc_now_iso()
         }
     except Exception as e:
         raise HTTPException(
@@ -1625,6 +1895,9 @@ async def generate_diagram(request: GenerateRequest, current_user: Dict = Depend
 
 from fastapi import Body
 
+# Upstream render errors that describe a bad request from our client, relayed with their own status
+MERMAID_PASSTHROUGH_STATUSES = frozenset({400, 413, 422})
+
 @app.post("/api/mermaid/render")
 async def render_mermaid(
     payload: dict = Body(...),
@@ -1636,32 +1909,43 @@ async def render_mermaid(
     if not token:
         raise HTTPException(status_code=500, detail="Mermaid API token not configured.")
 
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(
-                api_url,
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "code": payload.get("code"),
-                    "theme": payload.get("theme", "dark"),
-                    "format": payload.get("format", "svg")
-                }
-            )
-
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
-
-        # Return raw image
-        if payload.get("format", "svg") == "svg":
-            return Response(content=resp.content, media_type="image/svg+xml")
-        return Response(content=resp.content, media_type="image/png")
+    client = get_http_client()
+    upstream_request = client.build_request(
+        "POST",
+        api_url,
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "code": payload.get("code"),
+            "theme": payload.get("theme", "dark"),
+            "format": payload.get("format", "svg")
+        }
+    )
 
+    try:
+        # Stream so the image is relayed to the client as it arrives instead of buffered whole
+        resp = await client.send(upstream_request, stream=True)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Mermaid render failed: {str(e)}")
 
+    if resp.status_code != 200:
+        detail = (await resp.aread()).decode(errors="replace")
+        await resp.aclose()
+        # Only errors about the diagram itself are the client's; anything else (e.g. a 401 from a bad
+        # MERMAID_API_TOKEN, which the frontend would take as an expired session) is a bad gateway
+        if resp.status_code in MERMAID_PASSTHROUGH_STATUSES:
+            raise HTTPException(status_code=resp.status_code, detail=detail)
+        logger.warning("Mermaid render upstream returned %s: %s", resp.status_code, detail[:200])
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Mermaid render failed: upstream returned {resp.status_code}")
+
+    # Return raw image
+    media_type = "image/svg+xml" if payload.get("format", "svg") == "svg" else "image/png"
+    return StreamingResponse(resp.aiter_bytes(), media_type=media_type, background=BackgroundTask(resp.aclose))
+
 if __name__ == "__main__":
     import uvicorn
+    # uvicorn's "auto" loop/http pick uvloop and httptools (the Procfile stack) when installed,
+    # and fall back to asyncio on Windows, where uvicorn[standard] doesn't install uvloop
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file